@@ -2,15 +2,24 @@
 # https://github.com/fmassa/vision/blob/voc_dataset/torchvision/datasets/voc.py
 
 import os
+import pickle
 import cv2
+import lmdb
 import numpy as np 
 from PIL import Image
 
-import xml.etree.ElementTree as ET 
+from lxml import etree as ET
 
 import torch.utils.data
 from utils.transform import *
 
+# libjpeg-turbo decodes straight to RGB, fall back to OpenCV when it is missing
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    _turbo_jpeg = None
+
 
 class VOC(object):
     N_CLASSES = 20
@@ -37,13 +46,10 @@ class Viz(object):
         self.id_to_label = voc.id_to_label
         self.label_to_id = voc.label_to_id
 
-        colors = {}
-        for label in classes:
-            id = self.label_to_id[label]
-            color = self._to_color(id, len(classes))
-            colors[id] = color
-            colors[label] = color
-        self.colors =colors
+        # (N_CLASSES, 3) uint8, indexed by label id
+        # clipped the way cv2 saturates negative color components
+        colors = [self._to_color(i, len(classes)) for i in range(len(classes))]
+        self.colors = np.clip(colors, 0, 255).astype(np.uint8)
 
     def _to_color(self, indx, n_classes):
         base = int(np.ceil(pow(n_classes, 1./3)))
@@ -62,12 +68,12 @@ class Viz(object):
         if relative:
             bboxes = bboxes * [w, h, w, h]
 
-        bboxes = bboxes.astype(np.int)
-        labels = labels.astype(np.int)
+        bboxes = bboxes.astype(np.int32)
+        labels = labels.astype(np.int32)
 
         for bbox, label in zip(bboxes, labels):
             left, top, right, bot = bbox
-            color = self.colors[label]
+            color = tuple(int(c) for c in self.colors[label])
             label = self.id_to_label[label]
             cv2.rectangle(img, (left, top), (right, bot), color, 2)
             cv2.putText(img, label, (left+1, top-5), cv2.FONT_HERSHEY_DUPLEX, 0.4, color, 1, cv2.LINE_AA)
@@ -84,6 +90,9 @@ class Viz(object):
 
 
 class ParseAnnotation(object):
+    # bump whenever the parsed output changes (classes, offsets, dtypes), invalidates the annotation caches
+    VERSION = 1
+
     def __init__(self, keep_difficult=True):
         self.keep_difficult = keep_difficult
 
@@ -93,26 +102,26 @@ class ParseAnnotation(object):
 
     def __call__(self, target):
         tree = ET.parse(target).getroot()
+        objs = tree.findall('object')
 
-        bboxes = []
-        labels = []
-        for obj in tree.iter('object'):
-            difficult = int(obj.find('difficult').text) == 1
+        bboxes = np.empty((len(objs), 4), dtype=np.int32)
+        labels = np.empty(len(objs), dtype=np.int8)
+        n = 0
+        for obj in objs:
+            difficult = int(obj.findtext('difficult')) == 1
             if not self.keep_difficult and difficult:
                 continue
 
-            label = obj.find('name').text.lower().strip()
+            label = obj.findtext('name').lower().strip()
             if label not in self.classes:
                 continue
-            label = self.label_to_id[label]
 
             bndbox = obj.find('bndbox')
-            bbox = [int(bndbox.find(_).text) - 1 for _ in ['xmin', 'ymin', 'xmax', 'ymax']]
+            bboxes[n] = [int(bndbox.findtext(_)) - 1 for _ in ('xmin', 'ymin', 'xmax', 'ymax')]
+            labels[n] = self.label_to_id[label]
+            n += 1
 
-            bboxes.append(bbox)
-            labels.append(label)
-
-        return np.array(bboxes), np.array(labels)
+        return bboxes[:n], labels[:n]
 
 
 
@@ -123,38 +132,43 @@ class VOCDataset(torch.utils.data.Dataset):
         self.transform = transform
         self.target_transform = target_transform
 
-        self._imgpath = os.path.join('%s', 'JPEGImages', '%s.jpg')
-        self._annopath = os.path.join('%s', 'Annotations', '%s.xml')
-        self._segpath = os.path.join('%s', 'SegmentationClass', '%s.png')
-
         self.parse_annotation = ParseAnnotation(keep_difficult=keep_difficult)
 
+        # the split file already lists every id of the split once, in a fixed order
         self.ids = []
         for year, split in image_set:
             basepath = os.path.join(self.root, 'VOC' + str(year))
-            path = os.path.join(basepath, 'ImageSets', 'Main')
-            for file in os.listdir(path):
-                if not file.endswith('_' + split + '.txt'):
-                    continue
-                with open(os.path.join(path, file)) as f:
-                    for line in f:
-                        self.ids.append((basepath, line.strip()[:-3]))
-
-        self.ids = sorted(list(set(self.ids)), key=lambda _:_[0]+_[1])  # deterministic 
+            with open(os.path.join(basepath, 'ImageSets', 'Main', split + '.txt')) as f:
+                self.ids += [(basepath, line.strip()) for line in f if line.strip()]
+
+        # per-sample file paths, formatted once here instead of in every __getitem__
+        self._img_paths = [os.path.join(bp, 'JPEGImages', n + '.jpg') for bp, n in self.ids]
+        self._anno_paths = [os.path.join(bp, 'Annotations', n + '.xml') for bp, n in self.ids]
+        self._seg_paths = [os.path.join(bp, 'SegmentationClass', n + '.png') for bp, n in self.ids]
+
+        # boxes/labels of the whole split as flat tensors in shared memory, so DataLoader
+        # workers map the same pages instead of each faulting in its own copy of a dict of arrays
+        cache = self.load_annotations(keep_difficult)
+        annotations = [cache[img_id] for img_id in self.ids]
+        counts = [len(labels) for _, labels in annotations]
+        self._anno_offsets = torch.from_numpy(np.cumsum([0] + counts, dtype=np.int64)).share_memory_()
+        self._bboxes = torch.from_numpy(
+            np.concatenate([bboxes.reshape(-1, 4) for bboxes, _ in annotations]).astype(np.int32)).share_memory_()
+        self._labels = torch.from_numpy(
+            np.concatenate([labels for _, labels in annotations]).astype(np.int8)).share_memory_()
 
     def __getitem__(self, index):
-        img_id = self.ids[index]
-
-        img = cv2.imread(self._imgpath % img_id)[:, :, ::-1]
-        bboxes, det_labels = self.parse_annotation(self._annopath % img_id)
-        
-
-        if os.path.exists(self._segpath  % img_id):
-            seg_labels = Image.open(self._segpath % img_id)
-            seg_labels = np.array(seg_labels, dtype=np.uint8)
+        img = self.load_image(self._img_paths[index])
+        start, end = self._anno_offsets[index:index + 2].tolist()
+        bboxes, det_labels = self._bboxes[start:end].numpy(), self._labels[start:end].numpy()
+
+        # VOC masks are palette PNGs, cv2 would expand them to BGR so PIL is kept to read the indices
+        seg_path = self._seg_paths[index]
+        if os.path.exists(seg_path):
+            seg_labels = np.array(Image.open(seg_path), dtype=np.uint8)
         else:
-            seg_labels = np.zeros((img.shape[0], img.shape[1])) + 255
-        bboxes, det_labels = self.filter(img, bboxes, det_labels)
+            seg_labels = np.full(img.shape[:2], 255, dtype=np.uint8)
+        bboxes, det_labels = self.filter(bboxes, det_labels, *img.shape[:2])
         if self.transform is not None:
             img, bboxes, seg_labels = self.transform(img, bboxes, seg_labels)
 
@@ -164,26 +178,144 @@ class VOCDataset(torch.utils.data.Dataset):
         return img, bboxes, det_labels, torch.as_tensor(seg_labels, dtype=torch.long)
 
     def __len__(self):
-        return len(self.ids)
-
-    def filter(self, img, boxes, labels):
-        shape = img.shape
-        if len(shape) == 2:
-            h, w = shape
-        else:   # !!
-            if shape[0] > shape[2]:   # HWC
-                h, w = img.shape[:2]
-            else:                     # CHW
-                h, w = img.shape[1:]
-
-        boxes_ = []
-        labels_ = []
-        for box, label in zip(boxes, labels):
-            if min(box[2] - box[0], box[3] - box[1]) <= 0:
-                continue
-            if np.max(boxes) < 1 and np.sqrt((box[2] - box[0]) * w * (box[3] - box[1]) * h) < 8:
-                continue
-            boxes_.append(box)
-            labels_.append(label)
-        return np.array(boxes_), np.array(labels_)
-        
\ No newline at end of file
+        return len(self._img_paths)
+
+    def load_annotations(self, keep_difficult):
+        # parse every xml once and keep the result on disk
+        split = '_'.join(str(year) + split for year, split in self.image_set)
+        if not keep_difficult:
+            split += '_easy'
+        cache_path = os.path.join(self.root, '.anno_cache_%s.pkl' % split)
+
+        # rebuilt when the parser changes or any annotation is added, removed or edited,
+        # a directory mtime only moves on added/removed/renamed files so the xml mtimes count too
+        anno_dirs = sorted(set(os.path.dirname(path) for path in self._anno_paths))
+        mtime = max(os.stat(path).st_mtime_ns for path in anno_dirs + self._anno_paths)
+        stamp = (ParseAnnotation.VERSION, mtime)
+
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, 'rb') as f:
+                    cached = pickle.load(f)
+                if isinstance(cached, tuple) and cached[0] == stamp:
+                    cache = cached[1]
+                    if all(img_id in cache for img_id in self.ids):
+                        return cache
+            except (EOFError, pickle.UnpicklingError):   # damaged cache, rebuild it
+                pass
+
+        cache = {img_id: self.parse_annotation(path) for img_id, path in zip(self.ids, self._anno_paths)}
+
+        # write to a per-process temp file and swap it in atomically, ddp ranks
+        # build the dataset concurrently and must never see a half-written cache
+        tmp_path = '%s.%d.tmp' % (cache_path, os.getpid())
+        try:
+            with open(tmp_path, 'wb') as f:
+                pickle.dump((stamp, cache), f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, cache_path)
+        except OSError:   # read-only dataset root, keep the in-memory cache only
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        return cache
+
+    def load_image(self, path):
+        # returns a contiguous HWC uint8 RGB image
+        # decoding from memory also skips the Exif parsing done by cv2.imread
+        with open(path, 'rb') as f:
+            buf = f.read()
+        if _turbo_jpeg is not None and path.lower().endswith(('.jpg', '.jpeg')):
+            return _turbo_jpeg.decode(buf, pixel_format=TJPF_RGB)
+        img = cv2.imdecode(np.frombuffer(buf, np.uint8), cv2.IMREAD_COLOR)
+        return cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
+
+    def filter(self, boxes, labels, h, w):
+        if len(boxes) == 0:
+            return boxes, labels
+
+        wh = boxes[:, 2:] - boxes[:, :2]
+        keep = wh.min(axis=1) > 0
+        if boxes.max() < 1:   # relative coordinates
+            keep &= np.sqrt(wh[:, 0] * w * wh[:, 1] * h) >= 8
+        return boxes[keep], labels[keep]
+
+
+
+class VOCDatasetLMDB(torch.utils.data.Dataset):
+    # VOC samples pre-resized by build_lmdb.py, no JPEG/PNG decode and no Resize per sample
+    # record layout: img (size, size, 3) uint8 | seg (size, size) uint8 | bboxes (N, 4) float32 | labels (N,) int8
+
+    # lmdb refuses to open the same path twice in one process, so all instances share
+    # one environment per path, {path: (pid, env)}. the dict is inherited through fork,
+    # _open_env closes the parent's environment in the child and opens its own
+    _envs = {}
+
+    def __init__(self, path, transform=None, target_transform=None):
+        self.path = path
+        self.transform = transform
+        self.target_transform = target_transform
+
+        with self._open_env(path).begin() as txn:
+            meta = pickle.loads(txn.get(b'__meta__'))
+        self.size = meta['size']
+        self.length = meta['length']
+
+        # per-process read transaction on the shared environment, begun on the first
+        # __getitem__ and again whenever the instance finds itself in a new (worker) process
+        self._env = None
+        self._txn = None
+        self._pid = None
+
+    @classmethod
+    def _open_env(cls, path):
+        path = os.path.abspath(path)
+        pid, env = cls._envs.get(path, (None, None))
+        if pid != os.getpid():
+            if env is not None:   # inherited through fork and still counted as open by lmdb
+                env.close()
+            env = lmdb.open(path, readonly=True, lock=False, readahead=False, meminit=False)
+            cls._envs[path] = (os.getpid(), env)
+        return env
+
+    @staticmethod
+    def pack(img, bboxes, labels, seg):
+        return b''.join([
+            np.ascontiguousarray(img, dtype=np.uint8).tobytes(),
+            np.ascontiguousarray(seg, dtype=np.uint8).tobytes(),
+            np.asarray(bboxes, dtype=np.float32).reshape(-1, 4).tobytes(),
+            np.asarray(labels, dtype=np.int8).tobytes()])
+
+    @staticmethod
+    def unpack(buf, size):
+        # zero-copy read-only views into buf
+        n_img, n_seg = size * size * 3, size * size
+        n = (len(buf) - n_img - n_seg) // 17   # 4 float32 + 1 int8 per box
+        img = np.frombuffer(buf, np.uint8, n_img).reshape(size, size, 3)
+        seg = np.frombuffer(buf, np.uint8, n_seg, n_img).reshape(size, size)
+        bboxes = np.frombuffer(buf, np.float32, n * 4, n_img + n_seg).reshape(n, 4)
+        labels = np.frombuffer(buf, np.int8, n, n_img + n_seg + n * 16)
+        return img, bboxes, labels, seg
+
+    def __getitem__(self, index):
+        if self._txn is None or self._pid != os.getpid():
+            self._env = self._open_env(self.path)
+            self._txn = self._env.begin(buffers=True)   # read-only, buffers stay valid while it is open
+            self._pid = os.getpid()
+
+        img, bboxes, det_labels, seg_labels = self.unpack(self._txn.get(b'%08d' % index), self.size)
+        if self.transform is not None:
+            img, bboxes, seg_labels = self.transform(img, bboxes, seg_labels)
+
+        if self.target_transform is not None:
+            bboxes, det_labels = self.target_transform(bboxes, det_labels)
+
+        # astype copies, the mask may be a read-only or flipped view of the record
+        return img, bboxes, det_labels, torch.from_numpy(seg_labels.astype(np.int64))
+
+    def __len__(self):
+        return self.length
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_env'] = None
+        state['_txn'] = None
+        return state
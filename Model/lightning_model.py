@@ -7,7 +7,9 @@ import pytorch_lightning as pl
 from Model.model import PairNet
 from Model.model import TripleNet
 
-from utils.loss import MultiBoxLoss
+from utils.loss import compiled_multibox_loss
+from utils.transform import normalize_batch
+from Dataset.dataset import VOC
 from enum import Enum
 
 # Model Names Enum
@@ -23,7 +25,7 @@ class LightningModelPairNet(pl.LightningModule):
 
         self.model = PairNet(HPARAMS['n_classes'], HPARAMS['aspect_ratios'])
             
-        self.det_criterion = MultiBoxLoss()
+        self.det_criterion = compiled_multibox_loss()
         self.seg_criterion = torch.nn.CrossEntropyLoss(ignore_index=255)
 
         self.lr = HPARAMS['lr']
@@ -39,6 +41,10 @@ class LightningModelPairNet(pl.LightningModule):
     def forward(self, x):
         return self.model(x)
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        img, bboxes, det_labels, seg_labels = batch
+        return normalize_batch(img, VOC.MEAN), bboxes, det_labels, seg_labels
+
     def configure_optimizers(self):
         optimizer = torch.optim.SGD(self.parameters(), lr=self.lr)
         return [optimizer]
@@ -123,7 +129,7 @@ class LightningModelTripleNet(pl.LightningModule):
 
         self.model = TripleNet(HPARAMS['n_classes'], HPARAMS['aspect_ratios'])
             
-        self.det_criterion = MultiBoxLoss()
+        self.det_criterion = compiled_multibox_loss()
         self.seg_criterion = torch.nn.CrossEntropyLoss(ignore_index=255)
 
         self.lr = HPARAMS['lr']
@@ -140,6 +146,10 @@ class LightningModelTripleNet(pl.LightningModule):
     def forward(self, x):
         return self.model(x)
 
+    def on_after_batch_transfer(self, batch, dataloader_idx):
+        img, bboxes, det_labels, seg_labels = batch
+        return normalize_batch(img, VOC.MEAN), bboxes, det_labels, seg_labels
+
     def configure_optimizers(self):
         optimizer = torch.optim.SGD(self.parameters(), lr=self.lr)
         return [optimizer]
@@ -0,0 +1,55 @@
+from argparse import ArgumentParser
+import os
+import pickle
+
+import lmdb
+import numpy as np
+from tqdm import tqdm
+
+from Dataset.dataset import VOCDataset, VOCDatasetLMDB
+
+from utils.transform import *
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser(add_help=True)
+    parser.add_argument('--voc_root', type=str, default='VOCdevkit')
+    parser.add_argument('--voc_year', type=str, default='2007')
+    parser.add_argument('--split', type=str, default='train')
+    parser.add_argument('--size', type=int, default=300)
+    parser.add_argument('--out', type=str, default=None)
+
+    cfg = parser.parse_args()
+    cfg = vars(cfg)
+
+    out = cfg['out'] or os.path.join(cfg['voc_root'], 'VOC{}_{}_{}.lmdb'.format(cfg['voc_year'], cfg['split'], cfg['size']))
+
+    # spatial transforms only, boxes stay in pixels of the resized image
+    # photometric and random transforms are applied at training time
+    transform = Compose([
+            BoxesToCoords(),
+            Resize(cfg['size']),
+            CoordsToBoxes(relative=False),
+            ])
+
+    dataset = VOCDataset(
+        root=cfg['voc_root'], 
+        image_set=[(cfg['voc_year'], cfg['split'])],
+        keep_difficult=True,
+        transform=transform,
+        target_transform=None
+    )
+
+    # image + mask + generous room for the boxes and lmdb overhead
+    map_size = len(dataset) * (cfg['size'] * cfg['size'] * 4 + 4096) * 2
+    env = lmdb.open(out, map_size=map_size, writemap=True)
+    with env.begin(write=True) as txn:
+        for i in tqdm(range(len(dataset))):
+            img, bboxes, det_labels, seg_labels = dataset[i]
+            txn.put(b'%08d' % i, VOCDatasetLMDB.pack(img, bboxes, det_labels, seg_labels.numpy()))
+        txn.put(b'__meta__', pickle.dumps({'length': len(dataset), 'size': cfg['size']}))
+    env.sync()
+    env.close()
+
+    print('Wrote {} samples to {}'.format(len(dataset), out))
@@ -16,34 +16,58 @@ from Model.lightning_model import LightningModelPairNet, LightningModelTripleNet
 
 from Dataset.dataset import VOC, VOCDataset
 
-from utils.multibox import MultiBox
+from utils.multibox import MultiBox, ssd_collate
 from utils.transform import *
 from utils.metric import *
 
 from tqdm import tqdm 
 from mean_average_precision import MetricBuilder
 # SEED
-def seed_torch(seed=100):
+def seed_torch(seed=100, deterministic=False):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed) # if you are using multi-GPU.
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
+    # cuDNN autotuning is much faster but not bit-exact between runs
+    torch.backends.cudnn.benchmark = not deterministic
+    torch.backends.cudnn.deterministic = deterministic
     pl.utilities.seed.seed_everything(seed)
 
-seed_torch()
-
-# Convert batch data into cuda type if is_gpu flag is set
+# Convert the images and masks into cuda type if is_gpu flag is set
+# and normalize the uint8 images on that device
+# the ground truth boxes/labels are only read on the CPU, so they are not copied
 def preprocess_batch(batch, is_gpu=False):
     img, bboxes, det_labels, seg_labels = batch
     if is_gpu:
         dev = torch.device("cuda") if torch.cuda.is_available() else torch.device("cpu")
-        return img.to(dev), bboxes.to(dev), det_labels.to(dev), seg_labels.to(dev)
+        img = img.to(dev, non_blocking=True)
+        seg_labels = seg_labels.to(dev, non_blocking=True)
     
-    return img, bboxes, det_labels, seg_labels
+    return normalize_batch(img, VOC.MEAN), bboxes, det_labels, seg_labels
+
+# Decode the SSD outputs of one batch and add them to the mAP metric
+# copied is the CUDA event of the host copy of loc_hat/det_hat, if any
+def add_detections(metric_fn, encoder, loc_hat, det_hat, bboxes, det_labels, copied=None):
+    if copied is not None:
+        copied.synchronize()
+
+    # decode in fp32, autocast outputs may be fp16
+    loc_hat = loc_hat.float().numpy()
+    det_hat = det_hat.float().numpy()
+    np_bboxes = np.multiply(bboxes.numpy(), 100)
+    np_det_labels = det_labels.numpy()
+
+    for k in range(len(loc_hat)):
+        valid = np_det_labels[k] >= 0   # drop the ssd_collate padding
+        gt = np.concatenate((np_bboxes[k][valid], np.expand_dims(np_det_labels[k][valid], 1), np.zeros((valid.sum(), 2))), axis=1)
+
+        boxes, labels, scores = encoder.decode(loc_hat[k], det_hat[k], nms_thresh=0.5, conf_thresh=0.01)
+        boxes = np.multiply(boxes, 100)
+        pred = np.concatenate((boxes, np.expand_dims(labels, 1), np.expand_dims(scores, 1)), axis=1)
+
+        metric_fn.add(pred, gt)
 
 
 if __name__ == "__main__":
@@ -51,12 +75,12 @@ if __name__ == "__main__":
     parser = ArgumentParser(add_help=True)
     parser.add_argument('--voc_root', type=str, default='VOCdevkit')
     parser.add_argument('--voc_year', type=str, default='2007')
-    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--batch_size', type=int, default=16)
     parser.add_argument('--epochs', type=int, default=480)
     parser.add_argument('--lr', type=float, default=1e-3)
     parser.add_argument('--gpu', type=int, default=-1)
     parser.add_argument('--dev', type=str, default=False)
-    parser.add_argument('--n_workers', type=int, default=0)
+    parser.add_argument('--n_workers', type=int, default=4)
     parser.add_argument('--n_classes', type=int, default=20)
     parser.add_argument('--model', type=str, default=ModelNames.PairNet.value)
     parser.add_argument('--model_checkpoint', type=str, default=None)
@@ -70,6 +94,9 @@ if __name__ == "__main__":
     cfg = parser.parse_args()
     cfg = vars(cfg)
 
+    # --deterministic comes from the Trainer args
+    seed_torch(deterministic=bool(cfg['deterministic']))
+
     print('Training Model on TIMIT Dataset\n#Cores = {}\t#GPU = {}'.format(cfg['n_workers'], cfg['gpu']))
 
     encoder = MultiBox(cfg)
@@ -78,11 +105,16 @@ if __name__ == "__main__":
             BoxesToCoords(),
             Resize(300),
             CoordsToBoxes(),
-            [SubtractMean(mean=VOC.MEAN)],
-            [RGB2BGR()],
-            [ToTensor()],
             ])
 
+    # prefetch_factor and persistent_workers are only accepted with worker processes
+    loader_cfg = dict(
+        num_workers=cfg['n_workers'],
+        pin_memory=True
+    )
+    if cfg['n_workers'] > 0:
+        loader_cfg.update(persistent_workers=True, prefetch_factor=4)
+
     ## Test Dataset
     test_set = VOCDataset(
         root=cfg['voc_root'], 
@@ -95,9 +127,10 @@ if __name__ == "__main__":
     ## Validation Dataloader
     testloader = data.DataLoader(
         test_set, 
-        batch_size=1,
+        batch_size=cfg['batch_size'],
         shuffle=False, 
-        num_workers=cfg['n_workers']
+        collate_fn=ssd_collate,
+        **loader_cfg
     )
 
     ## Model
@@ -133,31 +166,48 @@ if __name__ == "__main__":
     i = 0
 
     metric_fn = MetricBuilder.build_evaluation_metric("map_2d", async_mode=True, num_classes=cfg['n_classes'])
-    for batch in tqdm(testloader):
-        img, bboxes, det_labels, seg_labels = preprocess_batch(batch, is_gpu)
-
-        np_bboxes = bboxes.squeeze(0).cpu().numpy()
-        np_bboxes = np.multiply(np_bboxes, 100)
-
-        np_det_labels = det_labels.squeeze(0).cpu().numpy()
-        gt = np.concatenate((np_bboxes, np.expand_dims(np_det_labels, 1), np.zeros((np_bboxes.shape[0], 2))), axis=1)
-
-        loc_hat, det_hat, seg_hat = model.model(img, is_eval=True)
-        b_pix_correct, b_n_label, b_intersec, b_uninion = seg_eval_metrics(seg_hat, seg_labels, cfg['n_classes'])
-        total_pix_correct += b_pix_correct
-        total_pix_labelled += b_n_label
-        arr_intersec = np.add(arr_intersec, b_intersec)
-        arr_union =  np.add(arr_union, b_uninion)
-
 
-        loc_hat = loc_hat.data.cpu().numpy()[0]
-        det_hat = det_hat.data.cpu().numpy()[0]
-
-        boxes, labels, scores = encoder.decode(loc_hat, det_hat, nms_thresh=0.5, conf_thresh=0.01)
-        boxes = np.multiply(boxes, 100)
-        pred = np.concatenate((boxes, np.expand_dims(labels, 1), np.expand_dims(scores, 1)), axis=1)
-
-        metric_fn.add(pred, gt)
+    # GPU outputs go to double-buffered pinned memory on a side stream, and each batch
+    # is decoded on the CPU while the next one is running on the GPU
+    copy_stream = torch.cuda.Stream() if is_gpu and torch.cuda.is_available() else None
+    loc_host, det_host = None, None
+    pending = None
+
+    with torch.inference_mode(), torch.cuda.amp.autocast(enabled=is_gpu):
+        for it, batch in enumerate(tqdm(testloader)):
+            img, bboxes, det_labels, seg_labels = preprocess_batch(batch, is_gpu)
+
+            loc_hat, det_hat, seg_hat = model.model(img, is_eval=True)
+
+            if copy_stream is None:
+                current = (loc_hat, det_hat, bboxes, det_labels)
+            else:
+                if loc_host is None:
+                    loc_host = torch.empty((2,) + tuple(loc_hat.shape), dtype=loc_hat.dtype, pin_memory=True)
+                    det_host = torch.empty((2,) + tuple(det_hat.shape), dtype=det_hat.dtype, pin_memory=True)
+                n, slot = len(loc_hat), it & 1
+
+                copy_stream.wait_stream(torch.cuda.current_stream())
+                with torch.cuda.stream(copy_stream):
+                    loc_host[slot, :n].copy_(loc_hat, non_blocking=True)
+                    det_host[slot, :n].copy_(det_hat, non_blocking=True)
+                    copied = copy_stream.record_event()
+                loc_hat.record_stream(copy_stream)
+                det_hat.record_stream(copy_stream)
+                current = (loc_host[slot, :n], det_host[slot, :n], bboxes, det_labels, copied)
+
+            if pending is not None:
+                add_detections(metric_fn, encoder, *pending)
+            pending = current
+
+            b_pix_correct, b_n_label, b_intersec, b_uninion = seg_eval_metrics(seg_hat, seg_labels, cfg['n_classes'])
+            total_pix_correct += b_pix_correct
+            total_pix_labelled += b_n_label
+            arr_intersec = np.add(arr_intersec, b_intersec)
+            arr_union =  np.add(arr_union, b_uninion)
+
+        if pending is not None:
+            add_detections(metric_fn, encoder, *pending)
 
     print(f"VOC PASCAL mAP in all points: {metric_fn.value(iou_thresholds=0.5)['mAP']}")
     print(eval_voc_segmentation(arr_intersec, arr_union, total_pix_correct, total_pix_labelled))
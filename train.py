@@ -1,4 +1,5 @@
 from argparse import ArgumentParser
+from functools import partial
 from multiprocessing import Pool
 import os
 import sys
@@ -17,25 +18,24 @@ import numpy as np
 
 from Model.lightning_model import LightningModelPairNet, LightningModelTripleNet, ModelNames
 
-from Dataset.dataset import VOC, VOCDataset
+from Dataset.dataset import VOC, VOCDataset, VOCDatasetLMDB
 
-from utils.multibox import MultiBox
+from utils.multibox import MultiBox, ssd_collate
 from utils.transform import *
 
 # SEED
-def seed_torch(seed=100):
+def seed_torch(seed=100, deterministic=False):
     random.seed(seed)
     os.environ['PYTHONHASHSEED'] = str(seed)
     np.random.seed(seed)
     torch.manual_seed(seed)
     torch.cuda.manual_seed(seed)
     torch.cuda.manual_seed_all(seed) # if you are using multi-GPU.
-    torch.backends.cudnn.benchmark = False
-    torch.backends.cudnn.deterministic = True
+    # cuDNN autotuning is much faster but not bit-exact between runs
+    torch.backends.cudnn.benchmark = not deterministic
+    torch.backends.cudnn.deterministic = deterministic
     pl.utilities.seed.seed_everything(seed)
 
-seed_torch()
-
 
 if __name__ == "__main__":
 
@@ -50,6 +50,7 @@ if __name__ == "__main__":
     parser.add_argument('--n_classes', type=int, default=20)
     parser.add_argument('--model', type=str, default=ModelNames.PairNet.value)
     parser.add_argument('--voc_year', type=str, default='2007')
+    parser.add_argument('--lmdb_root', type=str, default=None)
     parser.add_argument('--model_checkpoint', type=str, default=None)
     parser.add_argument('--upstream_model', type=str, default=None)
     parser.add_argument('--sizes', type=list, default=[s / 300. for s in [30, 60, 111, 162, 213, 264, 315]])
@@ -61,6 +62,10 @@ if __name__ == "__main__":
     cfg = parser.parse_args()
     cfg = vars(cfg)
 
+    # --deterministic comes from the Trainer args
+    cfg['deterministic'] = bool(cfg['deterministic'])
+    seed_torch(deterministic=cfg['deterministic'])
+
     print('Training Model on TIMIT Dataset\n#Cores = {}\t#GPU = {}'.format(cfg['n_workers'], cfg['gpu']))
 
     encoder = MultiBox(cfg)
@@ -71,44 +76,62 @@ if __name__ == "__main__":
             HorizontalFlip(),
             Resize(300),
             CoordsToBoxes(),
-            [SubtractMean(mean=VOC.MEAN)],
-            [RGB2BGR()],
-            [ToTensor()],
             ], RandomState(233), mode=None, fillval=VOC.MEAN)
-    target_transform = encoder.encode
-
+    # samples in the LMDB built by build_lmdb.py are already resized
+    lmdb_transform = Compose([
+            [ColorJitter(prob=0.5)],
+            BoxesToCoords(),
+            HorizontalFlip(),
+            CoordsToBoxes(),
+            ], RandomState(233), mode=None, fillval=VOC.MEAN)
+    # targets are encoded per batch in ssd_collate
+    target_transform = None
+
+    def voc_dataset(split):
+        if cfg['lmdb_root'] is not None:
+            return VOCDatasetLMDB(
+                os.path.join(cfg['lmdb_root'], 'VOC{}_{}_300.lmdb'.format(cfg['voc_year'], split)),
+                transform=lmdb_transform,
+                target_transform=target_transform
+            )
+        return VOCDataset(
+            root=cfg['voc_root'], 
+            image_set=[(cfg['voc_year'], split)],
+            keep_difficult=True,
+            transform=transform,
+            target_transform=target_transform
+        )
+
+
+    # DataLoader options shared by all splits
+    # prefetch_factor and persistent_workers are only accepted with worker processes
+    loader_cfg = dict(
+        num_workers=cfg['n_workers'],
+        pin_memory=True,
+        collate_fn=partial(ssd_collate, encoder=encoder)
+    )
+    if cfg['n_workers'] > 0:
+        loader_cfg.update(persistent_workers=True, prefetch_factor=4)
 
     # Training, Validation and Testing Dataset
     ## Training Dataset
-    train_set = VOCDataset(
-        root=cfg['voc_root'], 
-        image_set=[(cfg['voc_year'], 'train')],
-        keep_difficult=True,
-        transform=transform,
-        target_transform=target_transform
-    )
+    train_set = voc_dataset('train')
     ## Training DataLoader
     trainloader = data.DataLoader(
         train_set, 
         batch_size=cfg['batch_size'], 
         shuffle=True, 
-        num_workers=cfg['n_workers']
+        **loader_cfg
     )
     ## Validation Dataset
-    valid_set = VOCDataset(
-        root=cfg['voc_root'], 
-        image_set=[(cfg['voc_year'], 'val')],
-        keep_difficult=True,
-        transform=transform,
-        target_transform=target_transform
-    )
+    valid_set = voc_dataset('val')
 
     ## Validation Dataloader
     valloader = data.DataLoader(
         valid_set, 
         batch_size=cfg['batch_size'],
         shuffle=False, 
-        num_workers=cfg['n_workers']
+        **loader_cfg
     )
 
     print('Dataset Split (Train, Validation, Test)=', len(train_set), len(valid_set))
@@ -155,7 +178,10 @@ if __name__ == "__main__":
         logger=logger,
         resume_from_checkpoint=cfg['model_checkpoint'],
         distributed_backend='ddp',
-        auto_lr_find=True
+        auto_lr_find=True,
+        # the Trainer re-applies these cuDNN flags itself, overriding seed_torch
+        benchmark=not cfg['deterministic'],
+        deterministic=cfg['deterministic']
     )
     
     trainer.fit(model, train_dataloaders=trainloader, val_dataloaders=valloader)
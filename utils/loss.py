@@ -6,22 +6,30 @@ import torch.nn.functional as F
 class MultiBoxLoss(nn.Module):
     def __init__(self):
         super().__init__()
-        self.conf_loss = torch.nn.CrossEntropyLoss(ignore_index=-1)
+        self.conf_loss = torch.nn.CrossEntropyLoss(ignore_index=-1, reduction='none')
 
-    def _hard_negative_mining(self, loss, pos, neg, k):
-        loss = loss.detach()
-        rank = (loss * (-1 * neg.float())).sort(dim=1)[1].sort(dim=1)[1]
-        hard_neg = rank < (pos.long().sum(dim=1, keepdim=True) * k)
-        return hard_neg
+    def _hard_negative_mining(self, loss, pos, neg, k: int):
+        # keep the k * n_pos highest-loss negatives of each row, one topk instead of two sorts
+        loss = loss.detach().masked_fill(~neg, -float('inf'))
+        num_neg = pos.long().sum(dim=1, keepdim=True) * k
+        max_neg = min(int(num_neg.max()), loss.size(1))
 
-    def forward(self, xloc, xconf, loc, label, k=3):   # xconf is logits
+        hard_neg = torch.zeros_like(neg)
+        if max_neg == 0:
+            return hard_neg
+        idx = loss.topk(max_neg, dim=1)[1]
+        in_quota = torch.arange(max_neg, device=loss.device).unsqueeze(0) < num_neg
+        hard_neg.scatter_(1, idx, in_quota)
+        return hard_neg & neg
+
+    def forward(self, xloc, xconf, loc, label, k: int = 3):   # xconf is logits
         pos = label > 0
         neg = label == 0
         label = label.clamp(min=0)
     
-        pos_idx = pos.unsqueeze(-1).expand_as(xloc)
-        loc_loss = F.smooth_l1_loss(xloc[pos_idx].view(-1, 4), loc[pos_idx].view(-1, 4), 
-                                    size_average=False) 
+        # masked instead of gathered, no (n_pos, 4) copies
+        loc_loss = F.smooth_l1_loss(xloc, loc, reduction='none').sum(dim=-1)
+        loc_loss = (loc_loss * pos.float()).sum()
 
 
         conf_loss = self.conf_loss(xconf.transpose(1, 2), label)
@@ -31,3 +39,12 @@ class MultiBoxLoss(nn.Module):
 
         N = pos.data.float().sum() + 1e-3
         return loc_loss / N, conf_loss / N
+
+
+def compiled_multibox_loss():
+    # MultiBoxLoss with its masking and reductions fused into fewer kernels
+    # torch.compile on torch>=2.0 (the topk size is data dependent, so shapes are dynamic), TorchScript before
+    criterion = MultiBoxLoss()
+    if hasattr(torch, 'compile'):
+        return torch.compile(criterion, dynamic=True)
+    return torch.jit.script(criterion)
@@ -1,10 +1,13 @@
 
 import numpy as np
 import torch
+from torch.utils.data.dataloader import default_collate
 
 import itertools
 from numbers import Number
 
+from numba import njit, prange
+
 
 
 class MultiBox(object):
@@ -55,14 +58,31 @@ class MultiBox(object):
         if len(boxes) == 0:
             return (
                 torch.FloatTensor(np.zeros(self.anchor_boxes.shape, dtype=np.float32)),
-                torch.LongTensor(np.zeros(self.anchor_boxes.shape[0], dtype=np.int)))
+                torch.LongTensor(np.zeros(self.anchor_boxes.shape[0], dtype=np.int64)))
 
         iou = batch_iou(self.anchor_boxes_, boxes) 
+        idx, iou = self._match(iou)
+
+        boxes = boxes[idx]
+        loc = np.hstack([
+                ((boxes[:, :2] + boxes[:, 2:]) / 2. - self.anchor_boxes[:, :2]) / self.anchor_boxes[:, 2:],
+                np.log((boxes[:, 2:] - boxes[:, :2]) / self.anchor_boxes[:, 2:]),
+                ]) / self.prior_variance
+        
+        labels = labels[idx]
+        labels[iou < self.neg_thresh] = 0
+        labels[(self.neg_thresh <= iou) & (iou < self.pos_thresh)] = -1   # ignored during training
+
+        return torch.FloatTensor(loc.astype(np.float32)), torch.from_numpy(labels.astype(np.int64))
+
+    def _match(self, iou):
+        # iou: (P, m) of one image, modified in place
+        # returns the matched box of every anchor and its iou
         idx = iou.argmax(axis=1)
 
         # ensure each target box correspondes to at least one anchor box 
         iouc = iou.copy()
-        for _ in range(len(boxes)):
+        for _ in range(iou.shape[1]):
             i, j = np.unravel_index(iouc.argmax(), iouc.shape)
             if iouc[i, j] < 0.1:
                 continue
@@ -71,20 +91,45 @@ class MultiBox(object):
 
             idx[i] = j 
             iou[i, j] = 1.
-        iou = iou.max(axis=1)
-
-        boxes = boxes[idx]
-        loc = np.hstack([
-                ((boxes[:, :2] + boxes[:, 2:]) / 2. - self.anchor_boxes[:, :2]) / self.anchor_boxes[:, 2:],
-                np.log((boxes[:, 2:] - boxes[:, :2]) / self.anchor_boxes[:, 2:]),
-                ]) / self.prior_variance
-        
-        labels = labels[idx]
-        labels = labels
-        labels[iou < self.neg_thresh] = 0
-        labels[(self.neg_thresh <= iou) & (iou < self.pos_thresh)] = -1   # ignored during training
-
-        return torch.FloatTensor(loc.astype(np.float32)), torch.LongTensor(labels.astype(np.int))
+        return idx, iou.max(axis=1)
+
+    def encode_batch(self, boxes, labels):
+        # encode over a whole batch, same result as encode per sample
+        # boxes: list of (m, 4) l-t-r-b, labels: list of (m,), one entry per image
+        # the anchor iou is computed once over the concatenated boxes, so the cost
+        # follows the real number of boxes rather than B * max_boxes
+        B, P = len(boxes), len(self.anchor_boxes)
+        offsets = np.cumsum([0] + [len(_) for _ in labels])
+        loc = np.zeros((B, P, 4), dtype=np.float32)
+        conf = np.zeros((B, P), dtype=np.int64)
+        if offsets[-1] == 0:
+            return torch.from_numpy(loc), torch.from_numpy(conf)
+
+        all_boxes = np.concatenate([np.asarray(_, dtype=np.float64).reshape(-1, 4) for _ in boxes])
+        all_labels = np.concatenate([np.asarray(_, dtype=np.int64).reshape(-1) for _ in labels])
+        iou = batch_iou(self.anchor_boxes_, all_boxes)   # (P, sum(m))
+
+        has_boxes = offsets[1:] > offsets[:-1]
+        idx = np.zeros((B, P), dtype=np.int64)
+        max_iou = np.zeros((B, P))
+        for k in np.flatnonzero(has_boxes):
+            start, end = offsets[k], offsets[k + 1]
+            idx_k, max_iou[k] = self._match(iou[:, start:end])
+            idx[k] = idx_k + start
+
+        matched = all_boxes[idx[has_boxes]]   # (B', P, 4)
+        loc[has_boxes] = np.concatenate([
+                ((matched[..., :2] + matched[..., 2:]) / 2. - self.anchor_boxes[:, :2]) / self.anchor_boxes[:, 2:],
+                np.log((matched[..., 2:] - matched[..., :2]) / self.anchor_boxes[:, 2:]),
+                ], axis=-1) / self.prior_variance
+
+        matched_labels = all_labels[idx[has_boxes]]
+        max_iou = max_iou[has_boxes]
+        matched_labels[max_iou < self.neg_thresh] = 0
+        matched_labels[(self.neg_thresh <= max_iou) & (max_iou < self.pos_thresh)] = -1   # ignored during training
+        conf[has_boxes] = matched_labels
+
+        return torch.from_numpy(loc), torch.from_numpy(conf)
 
     
     def decode(self, loc, conf, nms_thresh=0.5, conf_thresh=0.5):
@@ -100,29 +145,82 @@ class MultiBox(object):
         conf /= conf.sum(axis=-1, keepdims=True)
         scores = conf[:, 1:]
 
-        chosen = np.zeros(len(scores), dtype=bool)
-        for i in range(scores.shape[1]):
-            keep = nms(boxes, scores[:, i], nms_thresh, conf_thresh)
-            scores[:, i] *= keep
-            chosen |= keep
+        keep = _nms_per_class(boxes, np.ascontiguousarray(scores), nms_thresh, conf_thresh)
+        scores = scores * keep
+        chosen = keep.any(axis=1)
 
         chosen &= (-scores.max(axis=1)).argsort().argsort() < 200
         return boxes[chosen], scores.argmax(axis=1)[chosen], scores.max(axis=1)[chosen]
 
 
+def ssd_collate(batch, encoder=None):
+    # collate_fn for VOCDataset without target_transform
+    # when a MultiBox encoder is given encodes the whole batch at once instead of per sample,
+    # otherwise pads boxes/labels to (B, max_boxes, ...) with label -1
+    imgs, boxes, labels, segs = zip(*batch)
+
+    # np.stack also accepts read-only and flipped image views
+    imgs = torch.from_numpy(np.stack(imgs))
+    if encoder is not None:
+        loc, conf = encoder.encode_batch(boxes, labels)
+        return imgs, loc, conf, default_collate(segs)
+
+    max_boxes = max(len(_) for _ in labels)
+    boxes_ = np.zeros((len(batch), max_boxes, 4), dtype=np.float32)
+    labels_ = np.full((len(batch), max_boxes), -1, dtype=np.int64)
+    for i, (bbox, label) in enumerate(zip(boxes, labels)):
+        if len(label) > 0:
+            boxes_[i, :len(label)] = bbox
+            labels_[i, :len(label)] = label
+    return imgs, torch.from_numpy(boxes_), torch.from_numpy(labels_), default_collate(segs)
+
+
 def batch_iou(a, b):  
     # pairwise jaccard botween boxes a and boxes b
     # box: [left, top, right, bottom]
-    lt = np.maximum(a[:, np.newaxis, :2], b[:, :2])
-    rb = np.minimum(a[:, np.newaxis, 2:], b[:, 2:])
-    inter = np.clip(rb - lt, 0, None)
+    # per coordinate instead of on (len(a), len(b), 2) slices, no reductions over the last axis
+    w = np.minimum(a[:, np.newaxis, 2], b[:, 2]) - np.maximum(a[:, np.newaxis, 0], b[:, 0])
+    h = np.minimum(a[:, np.newaxis, 3], b[:, 3]) - np.maximum(a[:, np.newaxis, 1], b[:, 1])
+    area_i = np.maximum(w, 0, out=w)
+    area_i *= np.maximum(h, 0, out=h)
 
-    area_i = np.prod(inter, axis=2)
-    area_a = np.prod(a[:, 2:] - a[:, :2], axis=1)
-    area_b = np.prod(b[:, 2:] - b[:, :2], axis=1)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
 
     area_u = area_a[:, np.newaxis] + area_b - area_i
-    return area_i / np.clip(area_u, 1e-7, None)  # shape: (len(a) x len(b))
+    return area_i / np.maximum(area_u, 1e-7, out=area_u)  # shape: (len(a) x len(b))
+
+
+@njit(parallel=True, cache=True, fastmath=True)
+def _nms_per_class(boxes, scores, nms_thresh, conf_thresh, topk=400):
+    # compiled equivalent of calling nms() on every column of scores, classes run in parallel
+    # boxes: (N, 4) l-t-r-b, scores: (N, C), returns the (N, C) keep mask
+    n, n_classes = scores.shape
+    keep = np.zeros((n, n_classes), dtype=np.bool_)
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+    for c in prange(n_classes):
+        score = scores[:, c]
+        order = np.argsort(-score)[:topk]
+        kept = np.empty(len(order), dtype=np.int64)
+        n_kept = 0
+        for i in order:
+            if score[i] < conf_thresh:
+                break
+            suppressed = False
+            for t in range(n_kept):
+                j = kept[t]
+                w = min(boxes[i, 2], boxes[j, 2]) - max(boxes[i, 0], boxes[j, 0])
+                h = min(boxes[i, 3], boxes[j, 3]) - max(boxes[i, 1], boxes[j, 1])
+                inter = max(w, 0.) * max(h, 0.)
+                if inter / max(areas[i] + areas[j] - inter, 1e-7) >= nms_thresh:
+                    suppressed = True
+                    break
+            if not suppressed:
+                kept[n_kept] = i
+                n_kept += 1
+                keep[i, c] = True
+    return keep
 
 
 def nms(boxes, scores, nms_thresh=0.45, conf_thresh=0, topk=400, topk_after=50):
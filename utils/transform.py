@@ -406,6 +406,28 @@ class ToTensor(object):
             # TODO
             pass
 
+
+# BGR mean tensors keyed by (device, mean), built once instead of copied to the device every batch
+_batch_means = {}
+
+
+def normalize_batch(img, mean):
+    # SubtractMean + RGB2BGR + ToTensor fused into one pass over a collated batch,
+    # run after the batch is moved to its device
+    # (B, H, W, 3) uint8 RGB -> (B, 3, H, W) float32 BGR, mean is given as R,G,B
+    key = (img.device, tuple(mean))
+    if key not in _batch_means:
+        _batch_means[key] = torch.as_tensor(mean[::-1], dtype=torch.float32, device=img.device)
+    mean = _batch_means[key]
+
+    # each RGB channel is converted and mean-subtracted straight into its BGR slot
+    B, H, W, _ = img.shape
+    out = torch.empty((B, 3, H, W), dtype=torch.float32, device=img.device)
+    for c in range(3):
+        torch.sub(img[..., 2 - c], mean[c], out=out[:, c])
+    return out
+
+
 class ToLongTensor(object):
     def __init__(self):
         pass 
@@ -438,7 +460,8 @@ class BoxesToCoords(object):
             boxes[:, 2] *= w
             boxes[:, 1] *= h
             boxes[:, 3] *= h
-        return img, np.vstack([self.bbox2coords(_) for _ in boxes]), seg
+        # (N, 4) -> (4N, 2) corners in bbox2coords order, keeps the box dtype
+        return img, boxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 2), seg
 
 
 class CoordsToBoxes(object):